@@ -21,14 +21,17 @@ cfg = LanguageModelSAETrainingConfig(
     dataset_path = "data/openwebtext",              # The corpus name or path. Each of a data record should contain (and may only contain) a "text" field.
     is_dataset_tokenized = False,                   # Whether the dataset is tokenized.
     is_dataset_on_disk = True,                      # Whether the dataset is on disk. If not on disk, `datasets.load_dataset`` will be used to load the dataset, and the train split will be used for training.
+    is_dataset_streaming = False,                   # Whether to stream the dataset instead of materializing it before training. Only used if the dataset is not on disk.
     concat_tokens = False,                          # Whether to concatenate tokens into a single sequence. If False, only data record with length of non-padding tokens larger than `context_size` will be used.
     context_size = 256,                             # The sequence length of the text dataset.
     store_batch_size = 32,                          # The batch size for loading the corpus.
+    num_dataloader_workers = 2,                     # The number of worker processes loading the corpus in the background. 0 loads it in the main process.
 
     # ActivationStoreConfig
     hook_points = ["blocks.3.hook_mlp_out"],         # The hook point to extract the activations, i.e. the layer output of which is used for training/evaluating the dictionary.
     use_cached_activations = False,                 # Whether to use cached activations. Caching activation is now not recommended, as it may consume extremely large disk space. (May be tens of TBs for corpus like `openwebtext`)
     n_tokens_in_buffer = 500_000,                   # The number of tokens to store in the activation buffer. The buffer is used to shuffle the activations before training the dictionary.
+    store_dtype = torch.bfloat16,                   # The torch data type activations are kept in inside the buffer. Halves the buffer memory compared to float32. Batches are cast back to `dtype` for training.
     
     # SAEConfig
     hook_point_in = "blocks.3.hook_mlp_out",
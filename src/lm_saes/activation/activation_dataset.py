@@ -10,7 +10,7 @@ from lm_saes.config import ActivationGenerationConfig
 from lm_saes.activation.token_source import TokenSource
 
 
-@torch.no_grad()
+@torch.inference_mode()
 def make_activation_dataset(
     model: HookedTransformer,
     cfg: ActivationGenerationConfig
@@ -37,8 +37,8 @@ def make_activation_dataset(
     pbar = tqdm(total=total_generating_tokens, desc=f"Activation dataset Rank {cfg.rank}" if cfg.use_ddp else "Activation dataset")
 
     while n_tokens < total_generating_tokens:
-        act_dict = {hook_point: torch.empty((0, cfg.context_size, cfg.d_model), dtype=cfg.dtype, device=cfg.device) for hook_point in cfg.hook_points}
-        context = torch.empty((0, cfg.context_size), dtype=torch.long, device=cfg.device)
+        act_dict = {hook_point: [] for hook_point in cfg.hook_points}
+        context = []
 
         n_tokens_in_chunk = 0
 
@@ -46,14 +46,17 @@ def make_activation_dataset(
             tokens = token_source.next(cfg.store_batch_size)
             _, cache = model.run_with_cache(tokens, names_filter=cfg.hook_points)
             for hook_point in cfg.hook_points:
-                act = cache[hook_point]
-                act_dict[hook_point] = torch.cat([act_dict[hook_point], act], dim=0)
-            context = torch.cat([context, tokens], dim=0)
+                act_dict[hook_point].append(cache[hook_point])
+            context.append(tokens)
             n_tokens += tokens.size(0) * tokens.size(1)
             n_tokens_in_chunk += tokens.size(0) * tokens.size(1)
 
             pbar.update(tokens.size(0) * tokens.size(1))
 
+        # Concatenate each chunk once instead of growing the tensors batch by batch
+        act_dict = {hook_point: torch.cat(act_dict[hook_point], dim=0).to(dtype=cfg.dtype) for hook_point in cfg.hook_points}
+        context = torch.cat(context, dim=0)
+
         position = torch.arange(cfg.context_size, device=cfg.device, dtype=torch.long).unsqueeze(0).expand(context.size(0), -1)
         
         for hook_point in cfg.hook_points:
@@ -5,6 +5,7 @@ import random
 import torch
 
 from transformer_lens import HookedTransformer
+from transformer_lens.hook_points import HookPoint
 
 from einops import rearrange, repeat
 
@@ -38,18 +39,50 @@ class TokenActivationSource(ActivationSource):
         self.token_source = TokenSource.from_config(model=model, cfg=cfg)
         self.model = model
         self.cfg = cfg
+
+        # Only the blocks up to the deepest hook point need to run. Hook points outside the blocks (e.g. `ln_final`) need the full forward pass.
+        if all(hook_point.startswith("blocks.") for hook_point in cfg.hook_points):
+            self.stop_at_layer = max(int(hook_point.split(".")[1]) for hook_point in cfg.hook_points) + 1
+        else:
+            self.stop_at_layer = None
+
+        # Tokens for the next step are fetched and copied to the device on a side stream while the model runs the current step.
+        self.copy_stream = torch.cuda.Stream(device=cfg.device) if torch.cuda.is_available() and torch.device(cfg.device).type == "cuda" else None
+        self.prefetched = False
+        self.prefetched_tokens: torch.Tensor | None = None
+
+    def _fetch_tokens(self) -> torch.Tensor | None:
+        if self.copy_stream is None:
+            return self.token_source.next(self.cfg.store_batch_size)
+        with torch.cuda.stream(self.copy_stream):
+            return self.token_source.next(self.cfg.store_batch_size)
     
     def next(self) -> Dict[str, torch.Tensor] | None:
-        tokens = self.token_source.next(self.cfg.store_batch_size)
+        tokens = self.prefetched_tokens if self.prefetched else self._fetch_tokens()
+        self.prefetched = False
 
         if tokens is None:
             return None
-        with torch.no_grad():
-            _, cache = self.model.run_with_cache(tokens, names_filter=self.cfg.hook_points)
 
-            ret = {k: rearrange(cache[k].to(dtype=self.cfg.dtype, device=self.cfg.device), "b l d -> (b l) d") for k in self.cfg.hook_points}
+        if self.copy_stream is not None:
+            torch.cuda.current_stream().wait_stream(self.copy_stream)
+            tokens.record_stream(torch.cuda.current_stream())
+
+        # Preallocate the outputs and let forward hooks copy the activations straight into them. This avoids building an activation cache and fuses the dtype/device cast into the copy.
+        ret = {k: torch.empty((tokens.size(0) * tokens.size(1), self.cfg.d_model), dtype=self.cfg.store_dtype, device=self.cfg.device) for k in self.cfg.hook_points}
 
-            return ret
+        def write_activation(act: torch.Tensor, hook: HookPoint):
+            ret[hook.name].copy_(rearrange(act, "b l d -> (b l) d"))
+
+        # `ret` is allocated outside inference mode, so it stays a normal tensor that can later be used in autograd.
+        with torch.inference_mode():
+            self.model.run_with_hooks(tokens, fwd_hooks=[(k, write_activation) for k in self.cfg.hook_points], stop_at_layer=self.stop_at_layer)
+
+        # The forward pass is only queued on the GPU at this point, so preparing the next batch of tokens overlaps with it.
+        self.prefetched_tokens = self._fetch_tokens()
+        self.prefetched = True
+
+        return ret
     
     def next_tokens(self, batch_size: int) -> torch.Tensor | None:
         return self.token_source.next(batch_size)
@@ -79,7 +112,7 @@ class CachedActivationSource(ActivationSource):
         if chunk is None:
             return None
         ret = {
-            self.hook_point: rearrange(chunk["activation"].to(dtype=self.cfg.dtype, device=self.cfg.device), "b l d -> (b l) d"),
+            self.hook_point: rearrange(chunk["activation"].to(dtype=self.cfg.store_dtype, device=self.cfg.device), "b l d -> (b l) d"),
             "position": rearrange(chunk["position"].to(dtype=torch.long, device=self.cfg.device), "b l -> (b l)"),
             "context": repeat(chunk["context"].to(dtype=torch.long, device=self.cfg.device), 'b l -> (b repeat) l', repeat=chunk["activation"].size(1)),
         }
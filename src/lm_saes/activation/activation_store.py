@@ -15,59 +15,92 @@ class ActivationStore:
         d_model: int,
         n_tokens_in_buffer=500000,
         device="cuda",
+        dtype=torch.float32,
         use_ddp=False
     ):
         self.act_source = act_source
         self.d_model = d_model
         self.buffer_size = n_tokens_in_buffer
         self.device = device
+        self.dtype = dtype
         self.use_ddp = use_ddp
         self._store: Dict[str, torch.Tensor] = {}
+        # `_store` is a single set of fixed buffers updated in place. `_order` holds the slots of the stored activations in the (shuffled) order they are served, `_cursor` points at the next one to serve, and `_free` holds slots that may be overwritten.
+        self._order = torch.empty((0,), dtype=torch.long, device=self.device)
+        self._free = torch.empty((0,), dtype=torch.long, device=self.device)
+        self._cursor = 0
         
     def initialize(self):
         self.refill()
-        self.shuffle()
 
-    def shuffle(self):
-        if len(self._store) == 0:
-            return
-        perm = torch.randperm(len(self._store[next(iter(self._store))]))
-        for k in self._store:
-            self._store[k] = self._store[k][perm]
+    def _grow(self, new_act: Dict[str, torch.Tensor]):
+        """
+        Enlarge the buffers so that `new_act` fits into the free slots. On the first refill this allocates room for `buffer_size` activations plus one batch from the activation source, which is the most a refill can hold.
+        """
+        n = next(iter(new_act.values())).size(0)
+        capacity = next(iter(self._store.values())).size(0) if len(self._store) > 0 else 0
+        new_capacity = max(self.buffer_size + n, capacity + n - self._free.size(0))
+        for k, v in new_act.items():
+            buffer = torch.empty((new_capacity, *v.shape[1:]), dtype=v.dtype, device=self.device)
+            if k in self._store:
+                buffer[:capacity] = self._store[k]
+            self._store[k] = buffer
+        self._free = torch.cat([self._free, torch.arange(capacity, new_capacity, dtype=torch.long, device=self.device)])
 
     def refill(self):
-        while self.__len__() < self.buffer_size:
+        """
+        Refill the store up to `buffer_size` activations and shuffle it.
+
+        New activations are written in place into the slots of already consumed ones, so the store is never copied or concatenated. Shuffling only permutes the slot indices in `_order`, not the activations themselves.
+        """
+        # Slots served since the last refill can be overwritten
+        self._free = torch.cat([self._free, self._order[:self._cursor]])
+        self._order = self._order[self._cursor:]
+        self._cursor = 0
+
+        new_slots = []
+        n_new = 0
+        while self.__len__() + n_new < self.buffer_size:
             new_act = self.act_source.next()
             if new_act is None:
                 break
-            for k, v in new_act.items():
-                v = v.to(self.device)
-                if k not in self._store:
-                    self._store[k] = v
-                else:
-                    self._store[k] = torch.cat([self._store[k], v], dim=0)
+            n = next(iter(new_act.values())).size(0)
             # Check if all activations have the same size
-            assert len(set(v.size(0) for v in self._store.values())) == 1
+            assert len(set(v.size(0) for v in new_act.values())) == 1
+
+            if self._free.size(0) < n:
+                self._grow(new_act)
+            slots, self._free = self._free[:n], self._free[n:]
+            for k, v in new_act.items():
+                self._store[k].index_copy_(0, slots, v.to(self.device))
+            new_slots.append(slots)
+            n_new += n
+
+        order = torch.cat([self._order, *new_slots])
+        # Generate the permutation where it is used, rather than serially on the CPU followed by a host-to-device copy
+        self._order = order[torch.randperm(order.size(0), device=self.device)]
 
     def __len__(self):
-        if len(self._store) == 0:
-            return 0
-        return next(iter(self._store.values())).size(0)
+        return self._order.size(0) - self._cursor
 
     def next(self, batch_size) -> Dict[str, torch.Tensor] | None:
         # Check if the activation store needs to be refilled.
-        need_refill = torch.tensor([self.__len__() < self.buffer_size // 2], device=self.device, dtype=torch.int)
+        need_refill = self.__len__() < self.buffer_size // 2
         if self.use_ddp: # When using DDP, we do refills in a synchronized manner to save time
-            dist.all_reduce(need_refill, op=dist.ReduceOp.MAX)
-        if need_refill.item() > 0:
+            # Only build a device tensor (and sync on it) when the decision has to be shared across processes
+            need_refill_tensor = torch.tensor([need_refill], device=self.device, dtype=torch.int)
+            dist.all_reduce(need_refill_tensor, op=dist.ReduceOp.MAX)
+            need_refill = need_refill_tensor.item() > 0
+        if need_refill:
             self.refill()
-            self.shuffle()
         if self.use_ddp: # Wait for all processes to refill the store
             dist.barrier()
 
-        ret = {k: v[:batch_size] for k, v in self._store.items()}
-        for k in self._store:
-            self._store[k] = self._store[k][batch_size:]
+        # Activations may be stored in a lower precision than the one used for training
+        n_rows = min(batch_size, self.__len__())
+        slots = self._order[self._cursor:self._cursor + n_rows]
+        ret = {k: v.index_select(0, slots).to(self.dtype) if v.is_floating_point() else v.index_select(0, slots) for k, v in self._store.items()}
+        self._cursor += n_rows
         return ret if len(ret) > 0 else None
         
     def next_tokens(self, batch_size: int) -> torch.Tensor | None:
@@ -87,5 +120,6 @@ class ActivationStore:
             d_model=cfg.d_model,
             n_tokens_in_buffer=cfg.n_tokens_in_buffer,
             device=cfg.device,
+            dtype=cfg.dtype,
             use_ddp=cfg.use_ddp,
         )
\ No newline at end of file
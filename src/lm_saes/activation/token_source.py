@@ -2,6 +2,7 @@ import torch
 from torch.utils.data import DataLoader
 
 from datasets import load_dataset, load_from_disk
+from datasets.distributed import split_dataset_by_node
 
 from transformer_lens import HookedTransformer
 
@@ -24,63 +25,107 @@ class TokenSource:
         self.seq_len = seq_len
         self.device = device
 
+        # Tokens are packed on the CPU and moved to `device` once per returned batch, so the packing does not launch small kernels on the GPU.
+        self.pin_memory = torch.cuda.is_available() and torch.device(device).type == "cuda"
+
         self.data_iter = iter(self.dataloader)
-        self.token_buffer = torch.empty((0, seq_len), dtype=torch.int64, device=self.device)
+        self.token_buffer = torch.empty((0, seq_len), dtype=torch.int64)
         if self.concat_tokens:
-            self.bos_token_id_tensor = torch.tensor([self.model.tokenizer.bos_token_id], dtype=torch.int64, device=self.device)
-            self.resid = self.bos_token_id_tensor.clone()
+            self.bos_token_id = int(self.model.tokenizer.bos_token_id)
+            # Concatenated tokens not yet packed into a row
+            self.resid = torch.empty((0,), dtype=torch.int64)
     
+    def _write_rows(self, ret: torch.Tensor, n_written: int, rows: torch.Tensor) -> int:
+        """
+        Copy as many of `rows` as still fit into the preallocated `ret`, keeping the rest in the token buffer for the next call.
+
+        Returns:
+            The number of rows of `ret` written so far.
+        """
+        n_rows = min(rows.size(0), ret.size(0) - n_written)
+        ret[n_written:n_written + n_rows] = rows[:n_rows]
+        if n_rows < rows.size(0):
+            self.token_buffer = torch.cat([self.token_buffer, rows[n_rows:]], dim=0)
+        return n_written + n_rows
+
     def next(self, batch_size: int) -> torch.Tensor | None:
-        while self.token_buffer.size(0) < batch_size:
+        ret = torch.empty((batch_size, self.seq_len), dtype=torch.int64, pin_memory=self.pin_memory)
+        n_written = min(self.token_buffer.size(0), batch_size)
+        ret[:n_written] = self.token_buffer[:n_written]
+        self.token_buffer = self.token_buffer[n_written:]
+
+        while n_written < batch_size:
             try:
                 batch = next(self.data_iter)
             except StopIteration:
+                # Keep the rows gathered so far, so that a later call with a smaller batch size can still use them.
+                self.token_buffer = torch.cat([ret[:n_written], self.token_buffer], dim=0)
                 return None
             if self.is_dataset_tokenized:
-                tokens: torch.Tensor = batch["tokens"].to(self.device)
+                tokens: torch.Tensor = batch["tokens"].cpu()
             else:
-                tokens = self.model.to_tokens(batch["text"]).to(self.device)
+                tokens = self.model.to_tokens(batch["text"], move_to_device=False)
             if self.concat_tokens:
-                while tokens.size(0) > 0:
-                    cur_tokens = tokens[0]
-                    cur_tokens = cur_tokens[torch.logical_and(cur_tokens != self.model.tokenizer.pad_token_id, cur_tokens != self.model.tokenizer.bos_token_id)]
-                    self.resid = torch.cat([self.resid, self.bos_token_id_tensor.clone(), cur_tokens], dim=0)
-                    while self.resid.size(0) >= self.seq_len:
-                        self.token_buffer = torch.cat([self.token_buffer, self.resid[:self.seq_len].unsqueeze(0)], dim=0)
-                        self.resid = self.resid[self.seq_len:]
-                        self.resid = torch.cat([self.bos_token_id_tensor.clone(), self.resid], dim=0)
-                    tokens = tokens[1:]
+                # Mask out padding and BOS tokens of the whole batch at once.
+                mask = torch.logical_and(tokens != self.model.tokenizer.pad_token_id, tokens != self.model.tokenizer.bos_token_id)
+                lengths = mask.sum(dim=1)
+
+                # Every document is preceded by a BOS token. Build the stream `BOS doc_0 BOS doc_1 ...` of the whole batch at once.
+                doc_starts = torch.cumsum(lengths + 1, dim=0) - (lengths + 1)
+                stream = torch.full((int(lengths.sum()) + lengths.size(0),), self.bos_token_id, dtype=torch.int64)
+                is_doc_token = torch.ones_like(stream, dtype=torch.bool)
+                is_doc_token[doc_starts] = False
+                stream[is_doc_token] = tokens[mask].to(torch.int64)
+                stream = torch.cat([self.resid, stream], dim=0)
+
+                # Each row is a BOS token followed by the next `seq_len - 1` tokens of the stream.
+                n_rows = stream.size(0) // (self.seq_len - 1)
+                rows = torch.empty((n_rows, self.seq_len), dtype=torch.int64)
+                rows[:, 0] = self.bos_token_id
+                rows[:, 1:] = stream[:n_rows * (self.seq_len - 1)].view(n_rows, self.seq_len - 1)
+                self.resid = stream[n_rows * (self.seq_len - 1):]
+                n_written = self._write_rows(ret, n_written, rows)
             else:
                 tokens = tokens[:, 1:]
                 if tokens.size(1) < self.seq_len:
                     continue
-                tokens = tokens[torch.logical_and(tokens[:, self.seq_len - 1] != self.model.tokenizer.pad_token_id, tokens[:, self.seq_len - 1] != self.model.tokenizer.eos_token_id), :self.seq_len]
-                self.token_buffer = torch.cat([self.token_buffer, tokens], dim=0)
+                keep = torch.logical_and(tokens[:, self.seq_len - 1] != self.model.tokenizer.pad_token_id, tokens[:, self.seq_len - 1] != self.model.tokenizer.eos_token_id)
+                # Datasets of uniform-length records (e.g. fixed-length game sequences) keep every row, so the rows can be copied as a slice instead of gathered by the mask
+                tokens = tokens[:, :self.seq_len] if bool(keep.all()) else tokens[keep, :self.seq_len]
+                n_written = self._write_rows(ret, n_written, tokens)
 
-        ret = self.token_buffer[:batch_size]
-        self.token_buffer = self.token_buffer[batch_size:]
-
-        return ret
+        return ret.to(self.device, non_blocking=True)
     
     @staticmethod
     def from_config(model: HookedTransformer, cfg: TextDatasetConfig):
         if not cfg.is_dataset_on_disk:
-            dataset = load_dataset(cfg.dataset_path, split="train", cache_dir=cfg.cache_dir)
+            dataset = load_dataset(cfg.dataset_path, split="train", cache_dir=cfg.cache_dir, streaming=cfg.is_dataset_streaming)
         else:
             dataset = load_from_disk(cfg.dataset_path)
+
+        # Only the column TokenSource reads is decoded, so the data loader does not fetch e.g. the raw text of a tokenized dataset.
+        column = "tokens" if cfg.is_dataset_tokenized else "text"
+        # Streaming datasets may not know their columns before the first record is read
+        if dataset.column_names is not None and column not in dataset.column_names:
+            raise ValueError(f"Dataset {cfg.dataset_path} has no '{column}' column (found {dataset.column_names}). Check `is_dataset_tokenized`.")
+        dataset = dataset.select_columns([column])
+        if cfg.is_dataset_tokenized:
+            # Return token rows as tensors straight from the Arrow buffers, so the default collate just stacks them instead of converting nested Python lists element by element.
+            dataset = dataset.with_format("torch")
+
         if cfg.use_ddp:
-            shard_id = cfg.rank
-            shard = dataset.shard(num_shards=cfg.world_size, index=shard_id)
-        else:
-            shard = dataset
-        
-        if cfg.use_ddp:
-            shard_id = cfg.rank
-            shard = dataset.shard(num_shards=cfg.world_size, index=shard_id)
+            # Works for both map-style and streaming datasets
+            shard = split_dataset_by_node(dataset, rank=cfg.rank, world_size=cfg.world_size)
         else:
             shard = dataset
             
-        dataloader = DataLoader(shard, batch_size=cfg.store_batch_size)
+        dataloader = DataLoader(
+            shard,
+            batch_size=cfg.store_batch_size,
+            num_workers=cfg.num_dataloader_workers,
+            persistent_workers=cfg.num_dataloader_workers > 0,
+            prefetch_factor=2 if cfg.num_dataloader_workers > 0 else None,
+        )
         return TokenSource(
             dataloader=dataloader,
             model=model,
@@ -84,9 +84,11 @@ class TextDatasetConfig(RunnerConfig):
     cache_dir: Optional[str] = None
     is_dataset_tokenized: bool = False
     is_dataset_on_disk: bool = False
+    is_dataset_streaming: bool = False  # Stream records with `datasets.load_dataset(..., streaming=True)` instead of downloading and materializing the whole dataset first. Ignored if the dataset is on disk
     concat_tokens: bool = True
     context_size: int = 128
     store_batch_size: int = 64
+    num_dataloader_workers: int = 2  # Number of worker processes loading dataset records in the background. 0 loads them in the main process
 
 
 @dataclass
@@ -100,9 +102,12 @@ class ActivationStoreConfig(LanguageModelConfig, TextDatasetConfig):
 
     # Activation Store Parameters
     n_tokens_in_buffer: int = 500_000
+    store_dtype: Optional[torch.dtype] = None  # The dtype activations are kept in inside the buffer. Batches are cast back to `dtype` when consumed. If None, it will be set to dtype
 
     def __post_init__(self):
         super().__post_init__()
+        if self.store_dtype is None:
+            self.store_dtype = self.dtype
         # Autofill cached_activations_path unless the user overrode it
         if self.cached_activations_path is None:
             self.cached_activations_path = f"activations/{self.dataset_path.split('/')[-1]}/{self.model_name.replace('/', '_')}_{self.context_size}"